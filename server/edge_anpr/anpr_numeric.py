@@ -0,0 +1,103 @@
+"""
+KINAMBA ANPR numeric helpers
+Numba-compiled pixel loops the edge service can use on its CPU preprocessing path
+(MOTION_BACKEND=numba). Run this file to benchmark them against the cv2 path:
+    python anpr_numeric.py
+"""
+
+import threading
+
+import numpy as np
+
+# Optional: pip install numba tbb
+try:
+    from numba import njit, prange, threading_layer
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+# The helpers are called from several ALPR worker threads at once. Numba's
+# workqueue layer (its fallback without TBB/OpenMP) aborts the process on
+# concurrent parallel calls, so calls are serialized until warmup() confirms
+# a thread-safe layer (TBB or OpenMP) was picked.
+_call_lock = threading.Lock()
+
+
+if HAS_NUMBA:
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _motion_bbox(prev, curr, thresh):
+        # Replaces absdiff + threshold + countNonZero + boundingRect without temporary images
+        rows, cols = prev.shape
+        n = 0
+        x0 = cols
+        y0 = rows
+        x1 = -1
+        y1 = -1
+
+        for i in prange(rows):
+            for j in range(cols):
+                if abs(np.int16(curr[i, j]) - np.int16(prev[i, j])) > thresh:
+                    n += 1
+                    x0 = min(x0, j)
+                    x1 = max(x1, j)
+                    y0 = min(y0, i)
+                    y1 = max(y1, i)
+
+        if n == 0:
+            return 0, 0, 0, 0, 0
+        return n, x0, y0, x1 - x0 + 1, y1 - y0 + 1
+
+
+def motion_bbox(prev, curr, thresh):
+    """
+    Count pixels whose absolute difference exceeds thresh, in a single pass.
+    Returns (count, x, y, w, h) of the changed area; w and h are 0 when nothing changed.
+    """
+    if _call_lock is None:
+        return _motion_bbox(prev, curr, thresh)
+    with _call_lock:
+        return _motion_bbox(prev, curr, thresh)
+
+
+def warmup():
+    """Compile (or load from cache) the helpers so the first frame doesn't pay for it"""
+    global _call_lock
+    if HAS_NUMBA:
+        dummy = np.zeros((2, 2), dtype=np.uint8)
+        motion_bbox(dummy, dummy, 25)
+        # The layer is only known after the first parallel call
+        if threading_layer() != 'workqueue':
+            _call_lock = None
+
+
+def benchmark(iterations=2000):
+    """Time motion_bbox against the cv2 absdiff/threshold/countNonZero/boundingRect path"""
+    import time
+    import cv2
+
+    rng = np.random.default_rng(0)
+    prev = rng.integers(0, 256, (180, 320), dtype=np.uint8)
+    static = prev.copy()
+    static[80:100, 150:200] ^= 0xFF
+    noisy = rng.integers(0, 256, (180, 320), dtype=np.uint8)
+
+    def cv2_path(a, b, thresh):
+        mask = cv2.threshold(cv2.absdiff(b, a), thresh, 255, cv2.THRESH_BINARY)[1]
+        return cv2.countNonZero(mask), cv2.boundingRect(mask)
+
+    candidates = [('cv2', cv2_path)]
+    if HAS_NUMBA:
+        warmup()
+        candidates.append(('numba', motion_bbox))
+
+    for label, curr in (('mostly static', static), ('noisy', noisy)):
+        for name, fn in candidates:
+            start = time.perf_counter()
+            for _ in range(iterations):
+                fn(prev, curr, 25)
+            per_call = (time.perf_counter() - start) / iterations * 1e6
+            print(f"{label:>13} {name:>5}: {per_call:8.1f} us/frame")
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,18 +1,29 @@
 """
 KINAMBA ANPR Edge Service
-Captures video from RTSP camera, detects plates, sends to ERM API
+Captures video from one or more RTSP cameras, detects plates, sends to ERM API
 """
 
 import cv2
 import requests
 import json
 import argparse
+import concurrent.futures
+from collections import OrderedDict, defaultdict, deque
 import os
+import pathlib
+import queue
+import threading
+import time
+import uuid
 from datetime import datetime
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
-# Optional: use OpenALPR or OpenCV for plate detection
-# pip install opencv-python python-dotenv requests
+import anpr_numeric
+
+# Plate detection uses OpenALPR
+# pip install opencv-python python-dotenv requests openalpr
+# (the binding needs the native libopenalpr and its runtime_data installed)
 
 load_dotenv()
 
@@ -21,178 +32,750 @@ ERM_API_KEY = os.getenv('ERM_API_KEY', 'your-api-key')
 CAMERA_ID = os.getenv('CAMERA_ID', 'CAM1')
 RTSP_URL = os.getenv('RTSP_URL', 'rtsp://camera-ip:554/stream')
 CONFIDENCE_THRESHOLD = int(os.getenv('CONFIDENCE_THRESHOLD', '85'))
+OPENALPR_CONFIG = os.getenv('OPENALPR_CONFIG', 'openalpr.conf')
+OPENALPR_RUNTIME = os.getenv('OPENALPR_RUNTIME', '/etc/openalpr/runtime_data')
+# auto: FFmpeg with any available hardware decoder, software: FFmpeg on the CPU,
+# gstreamer: NVDEC pipeline for Jetson boxes
+VIDEO_DECODER = os.getenv('VIDEO_DECODER', 'auto')
+
+
+def _parse_roi(value, name='DETECT_ROI'):
+    """Parse "x,y,w,h" (or a list of four ints) into a tuple; x/y must be >= 0 and w/h > 0"""
+    if not value:
+        return None
+    parts = value.split(',') if isinstance(value, str) else value
+    try:
+        x, y, w, h = (int(v) for v in parts)
+    except (ValueError, TypeError):
+        raise ValueError(f"{name} must be four integers x,y,w,h, got {value!r}")
+    if x < 0 or y < 0 or w <= 0 or h <= 0:
+        raise ValueError(f"{name} needs x,y >= 0 and w,h > 0, got {value!r}")
+    return (x, y, w, h)
+
+
+# Default lane region "x,y,w,h" to search for plates (cameras can override it in
+# CAMERAS_FILE), and the largest side (px) a frame is downscaled to before detection
+DETECT_ROI = _parse_roi(os.getenv('DETECT_ROI', ''))
+MAX_DETECT_SIZE = int(os.getenv('MAX_DETECT_SIZE', '960'))
+# Changed pixels (on a 320x180 thumbnail) needed before running detection
+MOTION_THRESHOLD = int(os.getenv('MOTION_THRESHOLD', '150'))
+MOTION_SIZE = (320, 180)
+# cv2 (default) or numba. Only switch to numba when `python anpr_numeric.py` shows it
+# beating cv2 on the target box - on typical CPUs the cv2 path is faster.
+MOTION_BACKEND = os.getenv('MOTION_BACKEND', 'cv2')
+# Detections are coalesced into one POST of up to BATCH_MAX_SIZE events
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', '16'))
+BATCH_MAX_WAIT = int(os.getenv('BATCH_MAX_WAIT_MS', '50')) / 1000.0
+# Seconds before retrying the batch route after ERM answered 404 for it
+BATCH_ROUTE_RECHECK = 600
+# A plate seen again within DEDUP_WINDOW seconds is not re-sent; the cache
+# holds DEDUP_CACHE_SIZE plates per camera
+DEDUP_WINDOW = 5
+DEDUP_CACHE_SIZE = 32
+# upload: PUT snapshots straight to storage via signed URLs from ERM (falls back to
+# local files when ERM can't provide one); local: write to snapshots/ only (offline mode)
+SNAPSHOT_MODE = os.getenv('SNAPSHOT_MODE', 'upload')
+# Signed upload URLs fetched from ERM per request. After a failed fetch, snapshots
+# go straight to local files for a cooldown that doubles up to the max.
+UPLOAD_URL_BATCH = 16
+UPLOAD_URL_COOLDOWN = 30
+UPLOAD_URL_COOLDOWN_MAX = 600
+# Optional JSON file listing cameras: [{"id": "CAM1", "url": "rtsp://...", "roi": [x, y, w, h]}, ...]
+# ("roi" is optional and defaults to DETECT_ROI)
+CAMERAS_FILE = os.getenv('CAMERAS_FILE', '')
+# Upper bound on detection threads (each loads its own OpenALPR models)
+ALPR_WORKERS = int(os.getenv('ALPR_WORKERS', '2'))
+# Consecutive failed frames before the service gives up (broken install, bad runtime_data)
+MAX_DETECT_ERRORS = int(os.getenv('MAX_DETECT_ERRORS', '50'))
+
+# Run preprocessing through OpenCV's T-API (OpenCL) when a device is available.
+# OPENCV_OPENCL_DEVICE selects the device, e.g. ":GPU:0"
+USE_OPENCL = os.getenv('USE_OPENCL', '1') == '1' and cv2.ocl.haveOpenCL()
+cv2.ocl.setUseOpenCL(USE_OPENCL)
+
+# Shared keep-alive session so each POST reuses the TCP/TLS connection
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8)
+_session.mount('https://', _adapter)
+_session.mount('http://', _adapter)
 
-# Simple plate detection using OCR (you can upgrade to OpenALPR)
-# For production, use: pip install openalpr-python
 try:
-    from alpr import Alpr
+    from openalpr import Alpr
     HAS_OPENALPR = True
 except ImportError:
     HAS_OPENALPR = False
-    print("OpenALPR not installed. Using fallback CV2 detection.")
 
-class ANPRService:
-    def __init__(self, camera_url, camera_id):
-        self.camera_url = camera_url
+
+def load_alpr():
+    """Load an OpenALPR instance. Instances are not thread-safe."""
+    alpr = Alpr("us", OPENALPR_CONFIG, OPENALPR_RUNTIME)
+    if not alpr.is_loaded():
+        raise RuntimeError(f"Failed to load OpenALPR (config {OPENALPR_CONFIG}, runtime {OPENALPR_RUNTIME})")
+    
+    alpr.set_top_n(1)
+    return alpr
+
+
+class FrameGrabber(threading.Thread):
+    """Reads frames for one camera on its own thread and keeps only the newest one"""
+    
+    def __init__(self, camera_id, camera_url, roi=None):
+        super().__init__(daemon=True)
         self.camera_id = camera_id
-        self.last_plate = None
-        self.last_plate_time = None
-        
-    def start(self):
-        """Start capturing from camera"""
-        print(f"Starting ANPR service for {self.camera_id}")
-        print(f"Connecting to {self.camera_url}...")
-        
-        cap = cv2.VideoCapture(self.camera_url)
-        
-        if not cap.isOpened():
-            print(f"ERROR: Cannot connect to camera {self.camera_url}")
-            return
+        self.camera_url = camera_url
+        # (x, y, w, h) lane region to search for plates, or None for the whole frame
+        self.roi = roi
+        # Held by the worker currently running detection for this camera
+        self.busy = threading.Lock()
+        self.prev_gray = None
+        self._lock = threading.Lock()
+        self._frame = None
+        # Set when a worker asked for a frame and found none ready
+        self._wanted = True
+        # Frames to grab without retrieving before preparing the next one
+        self._skip_left = 0
+        self._stopped = False
+        self.cap = self._open()
+        self._reset_pacing()
+    
+    def _open(self):
+        if VIDEO_DECODER == 'gstreamer':
+            # appsink keeps a single buffer and drops older ones
+            pipeline = (
+                f"rtspsrc location={self.camera_url} latency=0 ! rtph264depay ! h264parse ! "
+                "nvv4l2decoder ! nvvidconv ! video/x-raw,format=BGRx ! videoconvert ! "
+                "video/x-raw,format=BGR ! appsink drop=1 max-buffers=1 sync=false"
+            )
+            return cv2.VideoCapture(pipeline, cv2.CAP_GSTREAMER)
         
-        frame_count = 0
+        hwaccel = cv2.VIDEO_ACCELERATION_NONE if VIDEO_DECODER == 'software' else cv2.VIDEO_ACCELERATION_ANY
+        cap = cv2.VideoCapture(self.camera_url, cv2.CAP_FFMPEG, [cv2.CAP_PROP_HW_ACCELERATION, hwaccel])
+        # Keep FFmpeg from queueing stale frames behind the one we want
+        cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return cap
+    
+    def _reset_pacing(self):
+        """Forget measured detection latency and re-read the stream FPS"""
+        # EMA of seconds a worker spends on one of this camera's frames
+        self.det_ema = 0.0
+        fps = self.cap.get(cv2.CAP_PROP_FPS)
+        # RTSP sources often report 0 or a bogus timebase
+        self.stream_fps = fps if 1 <= fps <= 120 else 25
+    
+    def is_opened(self):
+        return self.cap.isOpened()
+    
+    def record_detection(self, seconds):
+        """Fold a measured detection time into the latency EMA"""
+        if self.det_ema == 0.0:
+            self.det_ema = seconds
+        else:
+            self.det_ema = 0.9 * self.det_ema + 0.1 * seconds
+    
+    def run(self):
+        # grab() pulls the next frame; retrieve() converts it to a BGR image.
+        # Frames nobody will look at are grabbed but never retrieved.
+        cap_grab, cap_retrieve = self.cap.grab, self.cap.retrieve
         
-        while True:
-            ret, frame = cap.read()
+        while not self._stopped:
+            if not cap_grab():
+                print(f"Lost connection to camera {self.camera_id}, reconnecting...")
+                with self._lock:
+                    self._frame = None
+                self.cap.release()
+                time.sleep(1)
+                self.cap = self._open()
+                self._reset_pacing()
+                cap_grab, cap_retrieve = self.cap.grab, self.cap.retrieve
+                continue
             
-            if not ret:
-                print("Lost connection to camera, reconnecting...")
-                cap.release()
-                cap = cv2.VideoCapture(self.camera_url)
+            # Skip frames that arrive while the worker is still busy with the last
+            # one. Once it's expected back (or asks), convert every frame so the
+            # one waiting for it is fresh.
+            if not self._wanted and self._skip_left > 0:
+                self._skip_left -= 1
                 continue
             
-            frame_count += 1
+            ret, frame = cap_retrieve()
+            if ret:
+                with self._lock:
+                    self._frame = frame
+                    self._wanted = False
+        
+        self.cap.release()
+    
+    def read(self):
+        """Return the latest frame, or None if nothing new since the last call"""
+        with self._lock:
+            frame = self._frame
+            self._frame = None
+            if frame is None:
+                self._wanted = True
+            else:
+                # Detection will take about det_ema seconds - that many frames go unused
+                self._skip_left = max(1, int(self.det_ema * self.stream_fps)) - 1
+        return frame
+    
+    def stop(self):
+        self._stopped = True
+
+
+class AlprWorker(threading.Thread):
+    """Runs plate detection for whichever cameras have a fresh frame"""
+    
+    def __init__(self, service):
+        super().__init__(daemon=True)
+        self.service = service
+        # Load OpenALPR once - constructing Alpr reloads its models from disk
+        self.alpr = load_alpr()
+    
+    def run(self):
+        service = self.service
+        errors = 0
+        
+        while not service._stopping.is_set():
+            worked = False
+            
+            for grabber in service.grabbers:
+                # Another worker is already on this camera
+                if not grabber.busy.acquire(blocking=False):
+                    continue
+                try:
+                    frame = grabber.read()
+                    if frame is None:
+                        continue
+                    
+                    worked = True
+                    t0 = time.monotonic()
+                    plates = service.detect_plates(grabber, frame, self.alpr)
+                    if plates:
+                        # One snapshot encode per frame, however many plates it holds
+                        ok, jpg = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+                        snapshot = jpg.tobytes() if ok else None
+                        for plate_data in plates:
+                            service.send_to_erm(grabber.camera_id, plate_data, snapshot)
+                    grabber.record_detection(time.monotonic() - t0)
+                    errors = 0
+                except Exception as e:
+                    # One bad frame must not take the worker (and its cameras) down,
+                    # but a detector that fails on every frame must not look healthy
+                    print(f"Detection error on {grabber.camera_id}: {e}")
+                    errors += 1
+                    if errors >= MAX_DETECT_ERRORS:
+                        service.fatal_error = f"{errors} consecutive detection errors, last: {e!r}"
+                        print(f"FATAL: {service.fatal_error}")
+                        service._stopping.set()
+                finally:
+                    grabber.busy.release()
             
-            # Process every Nth frame to reduce CPU usage
-            if frame_count % 10 != 0:
-                continue
+            # Detection time paces the loop; only idle-wait when no camera had a frame
+            if not worked:
+                time.sleep(0.005)
+        
+        self.alpr.unload()
+
+
+class ANPRService:
+    def __init__(self, cameras, num_workers=None):
+        """cameras: list of (camera_id, camera_url, roi)"""
+        # Fail at startup rather than silently detecting nothing on every frame
+        if not HAS_OPENALPR:
+            raise RuntimeError("No plate detector available; install openalpr")
+        
+        self.cameras = cameras
+        self.num_workers = num_workers or max(1, min(os.cpu_count() or 1, ALPR_WORKERS, len(cameras)))
+        self.grabbers = []
+        self.workers = []
+        # (camera_id, plate) -> last send time, oldest first
+        self._recent_plates = OrderedDict()
+        self._recent_lock = threading.Lock()
+        # Cameras already warned about an ROI outside their frame
+        self._roi_warned = set()
+        self._queue = queue.Queue(maxsize=256)
+        self._stopping = threading.Event()
+        # Set by a worker that gave up after MAX_DETECT_ERRORS failures in a row
+        self.fatal_error = None
+        # Set once nothing more can be queued, so the flusher knows it may exit
+        self._draining = threading.Event()
+        self._flusher_thread = threading.Thread(target=self._flusher, daemon=True)
+        # Until this monotonic time, post events one by one (ERM lacks the batch route)
+        self._batch_retry_at = 0.0
+        # Snapshot uploads/writes happen off the detection loop; several uploads overlap
+        self._io_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+        # camera_id -> (expires_at, slot) pairs of unused signed upload URLs
+        self._upload_urls = defaultdict(deque)
+        self._upload_urls_lock = threading.Lock()
+        # camera_id -> Event set when its in-flight URL fetch finishes (fetched outside the lock)
+        self._upload_urls_fetching = {}
+        # No URL fetches before this monotonic time (set after a failure)
+        self._upload_urls_retry_at = 0.0
+        self._upload_urls_cooldown = UPLOAD_URL_COOLDOWN
+        self._snapshot_dir = pathlib.Path('snapshots')
+        self._snapshot_dir.mkdir(exist_ok=True)
+        
+    def start(self):
+        """Start capturing from all cameras and block until interrupted"""
+        print(f"Starting ANPR service for {len(self.cameras)} camera(s) with {self.num_workers} worker(s)")
+        print(f"OpenCL preprocessing: {'enabled' if USE_OPENCL else 'unavailable, using CPU'}")
+        use_numba = self._use_numba_motion()
+        print(f"Motion gate backend: {'numba' if use_numba else 'cv2'}")
+        if use_numba:
+            anpr_numeric.warmup()
+        
+        if not self.cameras:
+            print("ERROR: No cameras configured")
+            self.stop()
+            return
+        
+        for camera_id, camera_url, roi in self.cameras:
+            print(f"Connecting to {camera_id} at {camera_url}...")
+            grabber = FrameGrabber(camera_id, camera_url, roi)
+            if not grabber.is_opened():
+                # Keep it - FrameGrabber.run reconnects until the camera comes up
+                print(f"ERROR: Cannot connect to camera {camera_url}, will keep retrying")
+            self.grabbers.append(grabber)
+        
+        try:
+            # One OpenALPR instance per worker, shared across all cameras
+            self.workers = [AlprWorker(self) for _ in range(self.num_workers)]
             
-            plates = self.detect_plates(frame)
+            for grabber in self.grabbers:
+                grabber.start()
+            self._flusher_thread.start()
+            for worker in self.workers:
+                worker.start()
             
-            if plates:
-                for plate_data in plates:
-                    self.send_to_erm(plate_data, frame)
+            while any(worker.is_alive() for worker in self.workers):
+                time.sleep(1)
+        finally:
+            self.stop()
+    
+    def stop(self):
+        """Stop cameras and workers, flush pending detections"""
+        self._stopping.set()
+        for worker in self.workers:
+            if worker.is_alive():
+                worker.join(timeout=5)
+        for grabber in self.grabbers:
+            grabber.stop()
+        for grabber in self.grabbers:
+            if grabber.is_alive():
+                grabber.join(timeout=2)
+            else:
+                grabber.cap.release()
         
-        cap.release()
+        # Pending snapshots still enqueue their detection, so finish them before draining
+        self._io_pool.shutdown(wait=True)
+        self._draining.set()
+        if self._flusher_thread.is_alive():
+            self._flusher_thread.join(timeout=5)
     
-    def detect_plates(self, frame):
-        """Detect license plates in frame"""
+    def detect_plates(self, camera, frame, alpr):
+        """Detect license plates in a frame from camera using OpenALPR"""
         plates = []
         
-        if HAS_OPENALPR:
-            plates = self._detect_with_openalpr(frame)
-        else:
-            plates = self._detect_with_cascade(frame)
+        if camera.roi:
+            x, y, w, h = camera.roi
+            frame = frame[y:y+h, x:x+w]
+            if frame.size == 0:
+                # Slicing clamps to the frame, so this only happens if the ROI lies outside it
+                if camera.camera_id not in self._roi_warned:
+                    self._roi_warned.add(camera.camera_id)
+                    print(f"WARNING: ROI {camera.roi} is outside {camera.camera_id}'s frame, skipping detection")
+                return plates
+        
+        # With OpenCL the frame is uploaded once here and reused for the motion gate and resize
+        src = cv2.UMat(frame) if USE_OPENCL else frame
+        roi = self._motion_roi(camera, frame, src)
+        if roi is None:
+            return plates
+        x, y, w, h = roi
+        frame = frame[y:y+h, x:x+w]
+        
+        # Detection cost scales with pixel count
+        longest = max(frame.shape[:2])
+        if longest > MAX_DETECT_SIZE:
+            scale = MAX_DETECT_SIZE / longest
+            if USE_OPENCL:
+                # Crop on the device; OpenALPR needs a numpy array, so download only after resizing
+                crop = cv2.UMat(src, (y, y + h), (x, x + w))
+                frame = cv2.resize(crop, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA).get()
+            else:
+                frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        
+        # Errors propagate to AlprWorker, which counts them
+        results = alpr.recognize_ndarray(frame)
+        
+        for result in results['results']:
+            if result['candidates']:
+                top_candidate = result['candidates'][0]
+                plate = top_candidate['plate'].upper()
+                confidence = top_candidate['confidence']
+                
+                # Deduplicate: only send if not seen in the last DEDUP_WINDOW seconds
+                if self._should_send_plate(camera.camera_id, plate):
+                    plates.append({
+                        'plate_number': plate,
+                        'confidence': confidence,
+                        'timestamp': datetime.utcnow().isoformat() + 'Z'
+                    })
         
         return plates
     
-    def _detect_with_openalpr(self, frame):
-        """Use OpenALPR for accurate plate detection"""
-        try:
-            alpr = Alpr("us", "openalpr.conf", "/etc/openalpr/runtime_data")
-            
-            if not alpr.is_loaded():
-                print("ERROR: Failed to load OpenALPR")
-                return []
-            
-            results = alpr.recognize_array(frame)
-            plates = []
-            
-            for result in results['results']:
-                if result['candidates']:
-                    top_candidate = result['candidates'][0]
-                    plate = top_candidate['plate'].upper()
-                    confidence = top_candidate['confidence']
-                    
-                    # Deduplicate: only send if different from last plate or 5+ seconds passed
-                    if self._should_send_plate(plate):
-                        plates.append({
-                            'plate_number': plate,
-                            'confidence': confidence,
-                            'timestamp': datetime.utcnow().isoformat() + 'Z'
-                        })
-            
-            return plates
-        except Exception as e:
-            print(f"OpenALPR error: {e}")
-            return []
+    def _use_numba_motion(self):
+        """Numba motion gate is opt-in and only applies to the CPU path"""
+        return MOTION_BACKEND == 'numba' and anpr_numeric.HAS_NUMBA and not USE_OPENCL
     
-    def _detect_with_cascade(self, frame):
-        """Fallback: use Haar Cascade + OCR (less accurate)"""
-        # This is a simplified example - in production use Tesseract or OpenALPR
-        # For now, just return placeholder
-        return []
+    def _motion_roi(self, camera, frame, src):
+        """
+        Return the (x, y, w, h) region that changed since camera's last frame, or None if static.
+        src is frame itself, or its UMat when OpenCL is in use.
+        """
+        # With OpenCL every step below stays on the device; prev_gray is kept as a UMat
+        gray = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY)
+        small = cv2.resize(gray, MOTION_SIZE)
+        prev = camera.prev_gray
+        camera.prev_gray = small
+        
+        if prev is None:
+            # Nothing to compare against yet - scan the whole frame
+            return (0, 0, frame.shape[1], frame.shape[0])
+        
+        if self._use_numba_motion():
+            # Fused single-pass diff/count/bbox on the CPU
+            changed, mx, my, mw, mh = anpr_numeric.motion_bbox(prev, small, 25)
+        else:
+            diff = cv2.absdiff(small, prev)
+            mask = cv2.threshold(diff, 25, 255, cv2.THRESH_BINARY)[1]
+            changed = cv2.countNonZero(mask)
+            mx, my, mw, mh = cv2.boundingRect(mask)
+        
+        if changed < MOTION_THRESHOLD:
+            return None
+        
+        # Scale the changed area back to full resolution, padded so plates at the edge survive
+        sx = frame.shape[1] / MOTION_SIZE[0]
+        sy = frame.shape[0] / MOTION_SIZE[1]
+        pad = 16
+        x0 = max(0, int((mx - pad) * sx))
+        y0 = max(0, int((my - pad) * sy))
+        x1 = min(frame.shape[1], int((mx + mw + pad) * sx))
+        y1 = min(frame.shape[0], int((my + mh + pad) * sy))
+        return (x0, y0, x1 - x0, y1 - y0)
     
-    def _should_send_plate(self, plate):
+    def _should_send_plate(self, camera_id, plate):
         """Prevent duplicate submissions"""
-        import time
         now = time.time()
+        key = (camera_id, plate)
         
-        if self.last_plate == plate:
-            # Same plate - only send if 5+ seconds passed
-            if self.last_plate_time and (now - self.last_plate_time) < 5:
+        with self._recent_lock:
+            last_sent = self._recent_plates.get(key)
+            if last_sent is not None and (now - last_sent) < DEDUP_WINDOW:
+                # Seen recently - skip, even if other plates were seen in between
                 return False
-        
-        self.last_plate = plate
-        self.last_plate_time = now
+            
+            self._recent_plates[key] = now
+            self._recent_plates.move_to_end(key)
+            if len(self._recent_plates) > DEDUP_CACHE_SIZE * len(self.cameras):
+                self._recent_plates.popitem(last=False)
         return True
     
-    def send_to_erm(self, plate_data, frame):
-        """Send plate detection to ERM API"""
+    def send_to_erm(self, camera_id, plate_data, snapshot):
+        """Queue plate detection for the ERM API (never blocks on HTTP). snapshot is JPEG bytes or None."""
         try:
-            # Optional: save snapshot
-            snapshot_path = f"snapshots/{self.camera_id}_{plate_data['plate_number']}_{datetime.now().timestamp()}.jpg"
-            os.makedirs('snapshots', exist_ok=True)
-            cv2.imwrite(snapshot_path, frame)
-            
             payload = {
                 'plate_number': plate_data['plate_number'],
                 'confidence': plate_data['confidence'],
                 'timestamp': plate_data['timestamp'],
-                'camera_id': self.camera_id,
-                'image_url': snapshot_path  # Or upload to S3/CDN and provide URL
+                'camera_id': camera_id,
+                'image_url': None,
+                # Lets ERM ignore a resend of an event it already recorded
+                'event_id': uuid.uuid4().hex
             }
             
-            headers = {
-                'x-api-key': ERM_API_KEY,
-                'Content-Type': 'application/json'
-            }
+            if snapshot is not None:
+                # The detection is queued once its snapshot has somewhere to live
+                self._io_pool.submit(self._store_and_queue, payload, snapshot)
+            else:
+                self._enqueue(payload)
+        
+        except Exception as e:
+            print(f"Error sending to ERM: {e}")
+    
+    def _enqueue(self, payload):
+        try:
+            self._queue.put_nowait(payload)
+        except queue.Full:
+            print(f"✗ Send queue full, dropping plate {payload['plate_number']}")
+    
+    def _store_and_queue(self, payload, buf):
+        """Worker thread: store the snapshot, then queue the detection with its URL"""
+        image_url = None
+        if SNAPSHOT_MODE == 'upload':
+            image_url = self._upload_snapshot(payload['camera_id'], buf)
+        if image_url is None:
+            path = f"{self._snapshot_dir}/{payload['camera_id']}_{payload['plate_number']}_{time.time_ns()}.jpg"
+            if self._write_snapshot(path, buf):
+                image_url = path
+        
+        payload['image_url'] = image_url
+        self._enqueue(payload)
+    
+    def _upload_snapshot(self, camera_id, buf):
+        """PUT the JPEG to a signed storage URL. Returns its image URL, or None on failure."""
+        slot = self._next_upload_url(camera_id)
+        if slot is None:
+            return None
+        
+        try:
+            response = _session.put(
+                slot['upload_url'],
+                data=buf,
+                headers={'Content-Type': 'image/jpeg'},
+                timeout=5
+            )
+        except requests.exceptions.RequestException as e:
+            print(f"Snapshot upload error: {e}")
+            return None
+        
+        if response.status_code not in (200, 201):
+            print(f"✗ Snapshot upload failed: {response.status_code} - {response.text}")
+            return None
+        return slot['image_url']
+    
+    def _next_upload_url(self, camera_id):
+        """Take an unexpired signed upload URL for camera_id, fetching a fresh batch from ERM when out"""
+        with self._upload_urls_lock:
+            url = self._pop_upload_url(camera_id)
+            if url or time.monotonic() < self._upload_urls_retry_at:
+                # Have one, or ERM failed recently - use the local fallback without asking again
+                return url
             
-            response = requests.post(
-                f"{ERM_API_URL}/api/camera/vehicle-entry",
-                json=payload,
-                headers=headers,
-                timeout=10
+            fetched = self._upload_urls_fetching.get(camera_id)
+            if fetched is None:
+                fetched = self._upload_urls_fetching[camera_id] = threading.Event()
+                fetching = True
+            else:
+                fetching = False
+        
+        if not fetching:
+            # Another upload is already fetching this camera's batch - share it
+            fetched.wait(timeout=6)
+            with self._upload_urls_lock:
+                return self._pop_upload_url(camera_id)
+        
+        # The HTTP round trip happens outside the lock so other cameras aren't held up
+        try:
+            response = _session.post(
+                f"{ERM_API_URL}/api/camera/snapshot-upload-urls",
+                json={'camera_id': camera_id, 'count': UPLOAD_URL_BATCH},
+                headers=_erm_headers(),
+                timeout=5
             )
+            response.raise_for_status()
+            result = response.json()
+            slots = result['urls']
+            if not slots:
+                raise ValueError('no upload URLs returned')
+            # Leave a minute of margin before the server-side expiry
+            expires_at = time.monotonic() + result.get('expires_in', 3600) - 60
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+            slots = None
+            error = e
+        
+        with self._upload_urls_lock:
+            del self._upload_urls_fetching[camera_id]
+            fetched.set()
+            if slots is None:
+                print(f"Could not get snapshot upload URLs, saving locally for {self._upload_urls_cooldown}s: {error}")
+                self._upload_urls_retry_at = time.monotonic() + self._upload_urls_cooldown
+                self._upload_urls_cooldown = min(self._upload_urls_cooldown * 2, UPLOAD_URL_COOLDOWN_MAX)
+                return None
             
-            if response.status_code == 200:
-                result = response.json()
-                print(f"✓ Plate {payload['plate_number']} sent successfully")
-                if result.get('alerts'):
-                    print(f"  ⚠️  Alerts: {len(result['alerts'])} triggered")
+            self._upload_urls_cooldown = UPLOAD_URL_COOLDOWN
+            self._upload_urls[camera_id].extend((expires_at, slot) for slot in slots)
+            return self._pop_upload_url(camera_id)
+    
+    def _pop_upload_url(self, camera_id):
+        """Caller holds _upload_urls_lock: drop expired URLs and take the next one, or None"""
+        now = time.monotonic()
+        urls = self._upload_urls[camera_id]
+        while urls and urls[0][0] <= now:
+            urls.popleft()
+        return urls.popleft()[1] if urls else None
+    
+    def _write_snapshot(self, path, buf):
+        """Worker thread: write an encoded JPEG to disk"""
+        try:
+            with open(path, 'wb') as f:
+                f.write(buf)
+            return True
+        except OSError as e:
+            print(f"Error writing snapshot {path}: {e}")
+            return False
+    
+    def _flusher(self):
+        """Background thread: batch queued detections and POST them to ERM"""
+        batch = []
+        backoff = 0.5
+        
+        while not (self._draining.is_set() and not batch and self._queue.empty()):
+            if not batch:
+                try:
+                    batch.append(self._queue.get(timeout=0.5))
+                except queue.Empty:
+                    continue
+            
+            # Give a burst of detections a short window to join the batch
+            deadline = time.monotonic() + BATCH_MAX_WAIT
+            while len(batch) < BATCH_MAX_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            batch = self._post_batch(batch)
+            if batch:
+                # Keep the failed events and retry with exponential backoff
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 30)
             else:
-                print(f"✗ Error: {response.status_code} - {response.text}")
+                backoff = 0.5
+    
+    def _post_batch(self, events):
+        """POST a batch of detections. Returns the events that should be retried."""
+        if time.monotonic() < self._batch_retry_at:
+            return self._post_each(events)
         
+        try:
+            response = _session.post(
+                f"{ERM_API_URL}/api/camera/vehicle-entry-batch",
+                json={'events': events},
+                headers=_erm_headers(),
+                timeout=10
+            )
         except requests.exceptions.RequestException as e:
+            # Resending is safe even if ERM got the batch - it skips known event_ids
             print(f"Network error: {e}")
-        except Exception as e:
-            print(f"Error sending to ERM: {e}")
+            return events
+        
+        if response.status_code == 404:
+            # Older ERM without the batch route - use the single-event endpoint for a while
+            print("Batch endpoint not available, posting detections individually")
+            self._batch_retry_at = time.monotonic() + BATCH_ROUTE_RECHECK
+            return self._post_each(events)
+        if response.status_code >= 500:
+            print(f"✗ Error: {response.status_code} - {response.text}")
+            return events
+        if response.status_code != 200:
+            # Client errors won't succeed on retry
+            print(f"✗ Error: {response.status_code} - {response.text}")
+            return []
+        
+        try:
+            results = response.json()['results']
+            if not isinstance(results, list):
+                raise ValueError('results is not a list')
+        except (ValueError, KeyError, TypeError) as e:
+            # e.g. a proxy answering 200 with an HTML page
+            print(f"✗ Unexpected batch response: {e} - {response.text[:200]}")
+            return events
+        
+        retry = []
+        for i, payload in enumerate(events):
+            result = results[i] if i < len(results) and isinstance(results[i], dict) else {}
+            status = result.get('status')
+            if not isinstance(status, int):
+                status = 500
+            if _report_result(payload, status, result.get('body') or {}):
+                retry.append(payload)
+        return retry
+    
+    def _post_each(self, events):
+        """POST detections one at a time to the single-event endpoint. Returns the events to retry."""
+        retry = []
+        for payload in events:
+            try:
+                response = _session.post(
+                    f"{ERM_API_URL}/api/camera/vehicle-entry",
+                    json=payload,
+                    headers=_erm_headers(),
+                    timeout=10
+                )
+            except requests.exceptions.RequestException as e:
+                print(f"Network error: {e}")
+                retry.append(payload)
+                continue
+            
+            try:
+                body = response.json()
+            except ValueError:
+                body = {'error': response.text[:200]}
+            if _report_result(payload, response.status_code, body):
+                retry.append(payload)
+        return retry
+
+def _erm_headers():
+    return {
+        'x-api-key': ERM_API_KEY,
+        'Content-Type': 'application/json'
+    }
+
+
+def _report_result(payload, status, body):
+    """Log one event's outcome. Returns True if it should be retried (server error)."""
+    if status == 200:
+        if body.get('duplicate'):
+            print(f"✓ Plate {payload['plate_number']} already recorded")
+            return False
+        print(f"✓ Plate {payload['plate_number']} sent successfully")
+        if body.get('alerts'):
+            print(f"  ⚠️  Alerts: {len(body['alerts'])} triggered")
+        return False
+    
+    print(f"✗ Error: {status} - {body}")
+    return status >= 500
+
+
+def load_cameras(path):
+    """Read a JSON list of {"id", "url", optional "roi"} camera entries"""
+    with open(path) as f:
+        entries = json.load(f)
+    
+    cameras = []
+    for cam in entries:
+        roi = _parse_roi(cam['roi'], f"roi of camera {cam['id']}") if cam.get('roi') else DETECT_ROI
+        cameras.append((cam['id'], cam['url'], roi))
+    return cameras
 
 
 def main():
+    global ERM_API_URL, ERM_API_KEY
+    
     parser = argparse.ArgumentParser(description='KINAMBA ANPR Edge Service')
     parser.add_argument('--camera-url', default=RTSP_URL, help='RTSP camera URL')
     parser.add_argument('--camera-id', default=CAMERA_ID, help='Camera identifier')
+    parser.add_argument('--cameras', default=CAMERAS_FILE, help='JSON file listing cameras (overrides --camera-url/--camera-id)')
     parser.add_argument('--api-url', default=ERM_API_URL, help='ERM API base URL')
     parser.add_argument('--api-key', default=ERM_API_KEY, help='ERM API key')
     
     args = parser.parse_args()
     
-    global ERM_API_URL, ERM_API_KEY
     ERM_API_URL = args.api_url
     ERM_API_KEY = args.api_key
     
-    service = ANPRService(args.camera_url, args.camera_id)
+    if args.cameras:
+        cameras = load_cameras(args.cameras)
+    else:
+        cameras = [(args.camera_id, args.camera_url, DETECT_ROI)]
+    
+    service = ANPRService(cameras)
     service.start()
+    if service.fatal_error:
+        raise SystemExit(f"ANPR service stopped: {service.fatal_error}")
 
 
 if __name__ == '__main__':
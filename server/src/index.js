@@ -4,6 +4,7 @@ import cors from 'cors';
 import bodyParser from 'body-parser';
 import dotenv from 'dotenv';
 import path from 'path';
+import { randomUUID } from 'crypto';
 import { fileURLToPath } from 'url';
 import { createClient } from '@supabase/supabase-js';
 import { createMonitor } from './heartbeat_monitor.js';
@@ -31,6 +32,9 @@ function stripEnv(v) { return v == null ? '' : String(v).trim().replace(/^\"|\"$
 const EDGE_API_KEY = stripEnv(process.env.EDGE_API_KEY);
 const SUPABASE_URL = stripEnv(process.env.SUPABASE_URL);
 const SUPABASE_SERVICE_ROLE_KEY = stripEnv(process.env.SUPABASE_SERVICE_ROLE_KEY);
+const SNAPSHOT_BUCKET = stripEnv(process.env.SNAPSHOT_BUCKET) || 'snapshots';
+// Supabase signed upload URLs are valid for 2 hours
+const SNAPSHOT_UPLOAD_URL_TTL_SEC = 2 * 60 * 60;
 
 if (!SUPABASE_URL || !SUPABASE_SERVICE_ROLE_KEY) {
   console.error('Missing Supabase configuration in environment. Ensure SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY are set in server/.env');
@@ -64,155 +68,244 @@ const hbMonitor = createMonitor(supabase, {
 });
 hbMonitor.start();
 
-// POST /api/camera/vehicle-entry
-app.post('/api/camera/vehicle-entry', async (req, res) => {
-  try {
-    const ip = req.ip || req.connection?.remoteAddress;
-    const body = req.body || {};
-    const { plate_number, timestamp, camera_id, image_url, confidence } = body;
+// Validate and record a single camera detection. Returns { status, body } so the
+// single-event and batch endpoints can share it.
+async function processVehicleEntry(body, ip) {
+  body = body || {};
+  const { plate_number, timestamp, camera_id, image_url, confidence, event_id } = body;
 
-    // Validation
-    if (!plate_number || String(plate_number).trim() === '') {
-      return res.status(400).json({ error: 'plate_number required' });
-    }
-    const conf = Number(confidence || 0);
-    if (isNaN(conf) || conf < 0) {
-      return res.status(400).json({ error: 'confidence numeric required' });
-    }
-    if (conf < 85) {
-      // Low confidence - reject
-      await supabase.from('audit_logs').insert({
-        action: 'VEHICLE_ENTRY_LOW_CONFIDENCE',
-        actor_id: null,
-        entity_type: 'camera_event',
-        details: { plate_number, confidence: conf, camera_id },
-        ip_address: ip
-      });
-      return res.status(422).json({ error: 'Low confidence', confidence: conf });
-    }
-
-    const eventTime = timestamp ? new Date(timestamp) : new Date();
+  // Validation
+  if (!plate_number || String(plate_number).trim() === '') {
+    return { status: 400, body: { error: 'plate_number required' } };
+  }
 
-    // Rule checks
-    // 1. Duplicate (already inside)
-    const { data: existingInside } = await supabase
+  // Edge devices retry batches whose response they never saw; an event_id we
+  // already recorded is acknowledged without inserting it again
+  if (event_id) {
+    const { data: recorded } = await supabase
       .from('garage_entries')
-      .select('id')
-      .eq('plate_number', plate_number)
-      .eq('status', 'inside')
-      .limit(1);
-
-    // 2. Capacity
-    const { data: capacityRow } = await supabase
-      .from('garage_settings')
-      .select('value')
-      .eq('key', 'capacity')
+      .select('*')
+      .eq('client_event_id', event_id)
       .maybeSingle();
-    let capacity = 0;
-    if (capacityRow && capacityRow.value) {
-      try { capacity = parseInt(capacityRow.value); } catch (e) { capacity = Number(capacityRow.value) || 0; }
+    if (recorded) {
+      return { status: 200, body: { ok: true, entry: recorded, alerts: [], duplicate: true } };
     }
-    const { count: insideCount } = await supabase
-      .from('garage_entries')
-      .select('id', { count: 'exact', head: true })
-      .eq('status', 'inside');
-
-    // 3. Operating hours
-    const { data: hoursRow } = await supabase
-      .from('garage_settings')
-      .select('value')
-      .eq('key', 'operating_hours')
-      .maybeSingle();
-    let afterHours = false;
-    if (hoursRow && hoursRow.value) {
-      try {
-        const v = typeof hoursRow.value === 'string' ? JSON.parse(hoursRow.value) : hoursRow.value;
-        const start = v.start || '00:00';
-        const end = v.end || '23:59';
-        const hh = eventTime.getHours();
-        const mm = eventTime.getMinutes();
-        const nowMinutes = hh * 60 + mm;
-        const [sH, sM] = start.split(':').map(Number);
-        const [eH, eM] = end.split(':').map(Number);
-        const startMinutes = sH * 60 + sM;
-        const endMinutes = eH * 60 + eM;
-        if (!(nowMinutes >= startMinutes && nowMinutes <= endMinutes)) afterHours = true;
-      } catch (e) {
-        // ignore
-      }
+  }
+  const conf = Number(confidence || 0);
+  if (isNaN(conf) || conf < 0) {
+    return { status: 400, body: { error: 'confidence numeric required' } };
+  }
+  if (conf < 85) {
+    // Low confidence - reject
+    await supabase.from('audit_logs').insert({
+      action: 'VEHICLE_ENTRY_LOW_CONFIDENCE',
+      actor_id: null,
+      entity_type: 'camera_event',
+      details: { plate_number, confidence: conf, camera_id },
+      ip_address: ip
+    });
+    return { status: 422, body: { error: 'Low confidence', confidence: conf } };
+  }
+
+  const eventTime = timestamp ? new Date(timestamp) : new Date();
+
+  // Rule checks
+  // 1. Duplicate (already inside)
+  const { data: existingInside } = await supabase
+    .from('garage_entries')
+    .select('id')
+    .eq('plate_number', plate_number)
+    .eq('status', 'inside')
+    .limit(1);
+
+  // 2. Capacity
+  const { data: capacityRow } = await supabase
+    .from('garage_settings')
+    .select('value')
+    .eq('key', 'capacity')
+    .maybeSingle();
+  let capacity = 0;
+  if (capacityRow && capacityRow.value) {
+    try { capacity = parseInt(capacityRow.value); } catch (e) { capacity = Number(capacityRow.value) || 0; }
+  }
+  const { count: insideCount } = await supabase
+    .from('garage_entries')
+    .select('id', { count: 'exact', head: true })
+    .eq('status', 'inside');
+
+  // 3. Operating hours
+  const { data: hoursRow } = await supabase
+    .from('garage_settings')
+    .select('value')
+    .eq('key', 'operating_hours')
+    .maybeSingle();
+  let afterHours = false;
+  if (hoursRow && hoursRow.value) {
+    try {
+      const v = typeof hoursRow.value === 'string' ? JSON.parse(hoursRow.value) : hoursRow.value;
+      const start = v.start || '00:00';
+      const end = v.end || '23:59';
+      const hh = eventTime.getHours();
+      const mm = eventTime.getMinutes();
+      const nowMinutes = hh * 60 + mm;
+      const [sH, sM] = start.split(':').map(Number);
+      const [eH, eM] = end.split(':').map(Number);
+      const startMinutes = sH * 60 + sM;
+      const endMinutes = eH * 60 + eM;
+      if (!(nowMinutes >= startMinutes && nowMinutes <= endMinutes)) afterHours = true;
+    } catch (e) {
+      // ignore
     }
+  }
 
-    const alerts = [];
+  const alerts = [];
 
-    if (existingInside && existingInside.length) {
-      alerts.push({ type: 'duplicate_entry', severity: 'critical', message: `Duplicate plate ${plate_number} already inside` });
-    }
+  if (existingInside && existingInside.length) {
+    alerts.push({ type: 'duplicate_entry', severity: 'critical', message: `Duplicate plate ${plate_number} already inside` });
+  }
 
-    if (capacity > 0 && typeof insideCount === 'number' && insideCount >= capacity) {
-      alerts.push({ type: 'capacity_warning', severity: 'warning', message: `Garage capacity exceeded (${insideCount}/${capacity})` });
-    }
+  if (capacity > 0 && typeof insideCount === 'number' && insideCount >= capacity) {
+    alerts.push({ type: 'capacity_warning', severity: 'warning', message: `Garage capacity exceeded (${insideCount}/${capacity})` });
+  }
 
-    if (afterHours) {
-      alerts.push({ type: 'after_hours', severity: 'warning', message: `Entry detected after operating hours for ${plate_number}` });
-    }
+  if (afterHours) {
+    alerts.push({ type: 'after_hours', severity: 'warning', message: `Entry detected after operating hours for ${plate_number}` });
+  }
 
-    // Insert garage entry record
-    const entryPayload = {
-      plate_number,
-      entry_time: eventTime.toISOString(),
-      camera_id: camera_id || null,
-      status: 'inside',
-      snapshot_url: image_url || null,
-      notes: JSON.stringify({ confidence: conf }),
-      created_by: null,
-      created_at: new Date().toISOString(),
-      source: 'cctv'
-    };
-
-    const { data: insertedEntry, error: insertErr } = await supabase
+  // Insert garage entry record
+  const entryPayload = {
+    plate_number,
+    entry_time: eventTime.toISOString(),
+    camera_id: camera_id || null,
+    status: 'inside',
+    snapshot_url: image_url || null,
+    notes: JSON.stringify({ confidence: conf }),
+    created_by: null,
+    created_at: new Date().toISOString(),
+    source: 'cctv',
+    client_event_id: event_id || null
+  };
+
+  const { data: insertedEntry, error: insertErr } = await supabase
+    .from('garage_entries')
+    .insert(entryPayload)
+    .select()
+    .single();
+
+  if (insertErr && insertErr.code === '23505' && event_id) {
+    // A concurrent retry of the same event won the insert
+    const { data: recorded } = await supabase
       .from('garage_entries')
-      .insert(entryPayload)
-      .select()
-      .single();
-
-    if (insertErr) {
-      console.error('Insert entry error', insertErr);
-      await supabase.from('audit_logs').insert({ action: 'VEHICLE_ENTRY_FAILED', details: { plate_number, error: insertErr.message }, ip_address: ip });
-      return res.status(500).json({ error: 'Failed to insert entry' });
-    }
+      .select('*')
+      .eq('client_event_id', event_id)
+      .maybeSingle();
+    return { status: 200, body: { ok: true, entry: recorded, alerts: [], duplicate: true } };
+  }
 
-    // Insert audit log
-    await supabase.from('audit_logs').insert({
-      action: 'VEHICLE_ENTRY',
-      actor_id: null,
-      entity_type: 'garage_entry',
-      entity_id: insertedEntry.id,
-      details: { plate_number, camera_id, confidence: conf },
-      ip_address: ip
+  if (insertErr) {
+    console.error('Insert entry error', insertErr);
+    await supabase.from('audit_logs').insert({ action: 'VEHICLE_ENTRY_FAILED', details: { plate_number, error: insertErr.message }, ip_address: ip });
+    return { status: 500, body: { error: 'Failed to insert entry' } };
+  }
+
+  // Insert audit log
+  await supabase.from('audit_logs').insert({
+    action: 'VEHICLE_ENTRY',
+    actor_id: null,
+    entity_type: 'garage_entry',
+    entity_id: insertedEntry.id,
+    details: { plate_number, camera_id, confidence: conf },
+    ip_address: ip
+  });
+
+  // Create alerts if any
+  for (const a of alerts) {
+    await supabase.from('alerts').insert({
+      garage_entry_id: insertedEntry.id,
+      vehicle_id: null,
+      type: a.type,
+      severity: a.severity === 'critical' ? 'critical' : 'warning',
+      message: a.message,
+      is_read: false,
+      created_at: new Date().toISOString()
     });
+  }
 
-    // Create alerts if any
-    for (const a of alerts) {
-      await supabase.from('alerts').insert({
-        garage_entry_id: insertedEntry.id,
-        vehicle_id: null,
-        type: a.type,
-        severity: a.severity === 'critical' ? 'critical' : 'warning',
-        message: a.message,
-        is_read: false,
-        created_at: new Date().toISOString()
-      });
-    }
+  // TODO: Trigger notifications / real-time push (frontend subscribes to DB changes)
 
-    // TODO: Trigger notifications / real-time push (frontend subscribes to DB changes)
+  return { status: 200, body: { ok: true, entry: insertedEntry, alerts } };
+}
 
-    return res.json({ ok: true, entry: insertedEntry, alerts });
+// POST /api/camera/vehicle-entry
+app.post('/api/camera/vehicle-entry', async (req, res) => {
+  try {
+    const ip = req.ip || req.connection?.remoteAddress;
+    const result = await processVehicleEntry(req.body, ip);
+    return res.status(result.status).json(result.body);
   } catch (err) {
     console.error('Error handling vehicle-entry', err);
     return res.status(500).json({ error: 'Internal server error' });
   }
 });
 
+// POST /api/camera/vehicle-entry-batch
+// Body: { events: [ <vehicle-entry payload>, ... ] } - events are processed in order
+app.post('/api/camera/vehicle-entry-batch', async (req, res) => {
+  try {
+    const ip = req.ip || req.connection?.remoteAddress;
+    const events = req.body && req.body.events;
+    if (!Array.isArray(events)) {
+      return res.status(400).json({ error: 'events array required' });
+    }
+
+    const results = [];
+    for (const event of events) {
+      try {
+        results.push(await processVehicleEntry(event, ip));
+      } catch (err) {
+        console.error('Error handling vehicle-entry batch event', err);
+        results.push({ status: 500, body: { error: 'Internal server error' } });
+      }
+    }
+
+    return res.json({ ok: true, results });
+  } catch (err) {
+    console.error('Error handling vehicle-entry-batch', err);
+    return res.status(500).json({ error: 'Internal server error' });
+  }
+});
+
+// POST /api/camera/snapshot-upload-urls
+// Body: { camera_id, count } - hands edge devices signed URLs so they can PUT
+// snapshot JPEGs straight to storage and report the resulting image_url
+app.post('/api/camera/snapshot-upload-urls', async (req, res) => {
+  try {
+    const { camera_id } = req.body || {};
+    const count = Math.min(Math.max(parseInt(req.body?.count, 10) || 1, 1), 64);
+    const prefix = String(camera_id || 'unknown').replace(/[^A-Za-z0-9_-]/g, '_');
+    const bucket = supabase.storage.from(SNAPSHOT_BUCKET);
+
+    const urls = [];
+    for (let i = 0; i < count; i++) {
+      const objectPath = `${prefix}/${randomUUID()}.jpg`;
+      const { data, error } = await bucket.createSignedUploadUrl(objectPath);
+      if (error) {
+        console.error('Create snapshot upload URL error', error);
+        return res.status(500).json({ error: 'Failed to create upload URL' });
+      }
+      // The bucket is public (supabase/migrations/20260205_snapshot_bucket.sql) so this
+      // URL works directly as the dashboard's <img src>
+      const { data: publicData } = bucket.getPublicUrl(objectPath);
+      urls.push({ upload_url: data.signedUrl, image_url: publicData.publicUrl });
+    }
+
+    return res.json({ ok: true, expires_in: SNAPSHOT_UPLOAD_URL_TTL_SEC, urls });
+  } catch (err) {
+    console.error('Error handling snapshot-upload-urls', err);
+    return res.status(500).json({ error: 'Internal server error' });
+  }
+});
+
 // POST /api/admin/fix-rls
 // Apply RLS policy fixes (admin only)
 app.post('/api/admin/fix-rls', async (req, res) => {
@@ -0,0 +1,16 @@
+-- Migration: Snapshot storage bucket
+-- Public bucket that edge ANPR devices upload plate snapshots into via signed
+-- upload URLs (POST /api/camera/snapshot-upload-urls). It is public so the
+-- stored snapshot_url can be used directly as an <img src> in the dashboard;
+-- object names are random UUIDs and only the service role can create upload URLs.
+
+BEGIN;
+
+INSERT INTO storage.buckets (id, name, public, file_size_limit, allowed_mime_types)
+VALUES ('snapshots', 'snapshots', true, 5242880, ARRAY['image/jpeg'])
+ON CONFLICT (id) DO UPDATE
+  SET public = EXCLUDED.public,
+      file_size_limit = EXCLUDED.file_size_limit,
+      allowed_mime_types = EXCLUDED.allowed_mime_types;
+
+COMMIT;
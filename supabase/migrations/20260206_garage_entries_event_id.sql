@@ -0,0 +1,15 @@
+-- Migration: Idempotent camera events
+-- Edge ANPR devices tag each detection with a client-generated event_id and may
+-- resend it after a timeout; the unique column lets the API skip events it has
+-- already recorded.
+
+BEGIN;
+
+ALTER TABLE public.garage_entries
+  ADD COLUMN IF NOT EXISTS client_event_id TEXT;
+
+CREATE UNIQUE INDEX IF NOT EXISTS garage_entries_client_event_id_key
+  ON public.garage_entries (client_event_id)
+  WHERE client_event_id IS NOT NULL;
+
+COMMIT;